@@ -296,3 +296,13 @@ sigma_all = {
               7 : sigma_7
             }
 
+
+# The nonzero entries of each sigma, flattened into parallel
+# (k, l, m, coefficient) arrays so the smoothness indicators can be
+# accumulated in a single loop
+def _sigma_nonzeros(sigma):
+    k, l, m = numpy.nonzero(sigma)
+    return k, l, m, numpy.asarray(sigma[k, l, m], dtype=numpy.float64)
+
+sigma_nnz_all = {order : _sigma_nonzeros(sigma)
+                 for order, sigma in sigma_all.items()}
@@ -1,5 +1,6 @@
 import sys
 import numpy
+import numba
 from matplotlib import pyplot
 import weno_coefficients
 import riemann
@@ -25,13 +26,14 @@ class Grid1d(object):
         self.dx = (xmax - xmin)/(nx)
         self.x = xmin + (numpy.arange(nx+2*ng)-ng+0.5)*self.dx
 
-        # storage for the solution
-        self.q = numpy.zeros((3,(nx+2*ng)), dtype=numpy.float64)
+        # storage for the solution -- indexed as q[i, component] so the
+        # conserved variables at a point are adjacent in memory
+        self.q = numpy.zeros(((nx+2*ng), 3), dtype=numpy.float64)
 
 
     def scratch_array(self):
         """ return a scratch array dimensioned for our grid """
-        return numpy.zeros((3, (self.nx+2*self.ng)), dtype=numpy.float64)
+        return numpy.zeros(((self.nx+2*self.ng), 3), dtype=numpy.float64)
 
 
     def fill_BCs(self):
@@ -40,25 +42,88 @@ class Grid1d(object):
         if self.bc == "periodic":
 
             # left boundary
-            self.q[:, 0:self.ilo] = self.q[:, self.ihi-self.ng+1:self.ihi+1]
+            self.q[0:self.ilo, :] = self.q[self.ihi-self.ng+1:self.ihi+1, :]
 
             # right boundary
-            self.q[:, self.ihi+1:] = self.q[:, self.ilo:self.ilo+self.ng]
+            self.q[self.ihi+1:, :] = self.q[self.ilo:self.ilo+self.ng, :]
 
         elif self.bc == "outflow":
 
-            for n in range(self.ng):
-                # left boundary
-                self.q[:, n] = self.q[:, self.ilo]
-    
-                # right boundary
-                self.q[:, self.ihi+1+n] = self.q[:, self.ihi]
+            # left boundary
+            self.q[0:self.ilo, :] = self.q[self.ilo:self.ilo+1, :]
+
+            # right boundary
+            self.q[self.ihi+1:, :] = self.q[self.ihi:self.ihi+1, :]
 
         else:
             sys.exit("invalid BC")
 
 
-def weno(order, q):
+# number of points handled together by one thread in a WENO kernel
+WENO_TILE = 32
+
+
+def _make_weno_kernel(order):
+    """
+    Generate a compiled WENO reconstruction kernel specialized to one
+    order, with signature kernel(q, qL).  q is C-contiguous and indexed
+    as q[i, component]; qL is filled in place at the interior points.
+
+    The loops over the stencils are written out in full with the
+    coefficients of weno_coefficients inserted as constants, so the
+    smoothness indicators and stencils become straight-line
+    multiply-adds.  The points are split into tiles of WENO_TILE that
+    are processed in parallel, and within a tile all the components are
+    reconstructed at each point before moving on.
+    """
+    C = weno_coefficients.C_all[order]
+    a = weno_coefficients.a_all[order]
+    sig_k, sig_l, sig_m, sig_c = weno_coefficients.sigma_nnz_all[order]
+
+    def qname(offset):
+        """ local variable holding q[i+offset, nv] """
+        if offset < 0:
+            return "q_m{}".format(-offset)
+        return "q_p{}".format(offset)
+
+    lines = ["def kernel(q, qL):",
+             "    npts = q.shape[0] - {}".format(2 * order),
+             "    epsilon = 1e-16",
+             "    ntiles = (npts + WENO_TILE - 1) // WENO_TILE",
+             "    for tile in numba.prange(ntiles):",
+             "        i0 = {} + tile * WENO_TILE".format(order),
+             "        for i in range(i0, min(i0 + WENO_TILE, npts+{})):".format(order),
+             "            for nv in range(q.shape[1]):"]
+    body = []
+    for offset in range(1-order, order):
+        body.append("{} = q[i+{}, nv]".format(qname(offset), offset))
+    for k in range(order):
+        terms = ["{!r} * {} * {}".format(float(c), qname(k-l), qname(k-m))
+                 for kk, l, m, c in zip(sig_k, sig_l, sig_m, sig_c) if kk == k]
+        body.append("beta{} = {}".format(k, " + ".join(terms)))
+        body.append("alpha{} = {!r} / (epsilon + abs(beta{})**{})".format(
+            k, float(C[k]), k, order))
+        terms = ["{!r} * {}".format(float(a[k, l]), qname(k-l))
+                 for l in range(order)]
+        body.append("qs{} = {}".format(k, " + ".join(terms)))
+    body.append("qL[i, nv] = ({}) / ({})".format(
+        " + ".join("alpha{} * qs{}".format(k, k) for k in range(order)),
+        " + ".join("alpha{}".format(k) for k in range(order))))
+    lines += [16*" " + line for line in body]
+
+    namespace = {"numba": numba, "WENO_TILE": WENO_TILE}
+    exec("\n".join(lines), namespace)
+    return numba.njit(parallel=True, boundscheck=False,
+                      fastmath=True)(namespace["kernel"])
+
+
+# one specialized kernel per supported order -- each is compiled on
+# first use
+_weno_kernels = {order : _make_weno_kernel(order)
+                 for order in weno_coefficients.C_all}
+
+
+def weno(order, q, qL=None):
     """
     Do WENO reconstruction
     
@@ -68,7 +133,10 @@ def weno(order, q):
     order : int
         The stencil width
     q : numpy array
-        Scalar data to reconstruct
+        Data to reconstruct, indexed as q[i, component]
+    qL : numpy array, optional
+        Contiguous storage for the result.  Only the interior points
+        are written, so its boundary points keep their values
         
     Returns
     -------
@@ -76,30 +144,13 @@ def weno(order, q):
     qL : numpy array
         Reconstructed data - boundary points are zero
     """
-    C = weno_coefficients.C_all[order]
-    a = weno_coefficients.a_all[order]
-    sigma = weno_coefficients.sigma_all[order]
-
-    qL = numpy.zeros_like(q)
-    beta = numpy.zeros((order, q.shape[1]))
-    w = numpy.zeros_like(beta)
-    np = q.shape[1] - 2 * order
-    epsilon = 1e-16
-    for nv in range(3):
-        for i in range(order, np+order):
-            q_stencils = numpy.zeros(order)
-            alpha = numpy.zeros(order)
-            for k in range(order):
-                for l in range(order):
-                    for m in range(l+1):
-                        beta[k, i] += sigma[k, l, m] * q[nv, i+k-l] * q[nv, i+k-m]
-#                alpha[k] = C[k] / (epsilon + beta[k, i]**2)
-                alpha[k] = C[k] / (epsilon + abs(beta[k, i])**order)
-                for l in range(order):
-                    q_stencils[k] += a[k, l] * q[nv, i+k-l]
-            w[:, i] = alpha / numpy.sum(alpha)
-            qL[nv, i] = numpy.dot(w[:, i], q_stencils)
-    
+    q = numpy.ascontiguousarray(q, dtype=numpy.float64)
+    if qL is None:
+        # the kernel fills everything but the boundary points
+        qL = numpy.empty_like(q)
+        qL[:order, :] = 0.0
+        qL[-order:, :] = 0.0
+    _weno_kernels[order](q, qL)
     return qL
 
 
@@ -111,6 +162,16 @@ class WENOSimulation(object):
         self.C = C   # CFL number
         self.weno_order = weno_order
         self.eos_gamma = eos_gamma # Gamma law EOS
+        self._max_lambda = None # max wavespeed, set by timestep()
+
+        # work buffers for the time update, reused every step
+        self._q_start = numpy.empty_like(grid.q)
+        self._acc = numpy.empty_like(grid.q)
+        self._flux = numpy.empty_like(grid.q)
+
+        # contiguous buffers for the mirrored (right-biased) reconstruction
+        self._rev_in = grid.scratch_array()
+        self._rev_out = grid.scratch_array()
 
     def init_cond(self, type="sod"):
         if type == "sod":
@@ -126,15 +187,9 @@ class WENOSimulation(object):
             e_r = p_r / rho_r / (self.eos_gamma - 1)
             E_l = rho_l * (e_l + v_l**2 / 2)
             E_r = rho_r * (e_r + v_r**2 / 2)
-            self.grid.q[0] = numpy.where(self.grid.x < 0,
-                                         rho_l * numpy.ones_like(self.grid.x),
-                                         rho_r * numpy.ones_like(self.grid.x))
-            self.grid.q[1] = numpy.where(self.grid.x < 0,
-                                         S_l * numpy.ones_like(self.grid.x),
-                                         S_r * numpy.ones_like(self.grid.x))
-            self.grid.q[2] = numpy.where(self.grid.x < 0,
-                                         E_l * numpy.ones_like(self.grid.x),
-                                         E_r * numpy.ones_like(self.grid.x))
+            left = self.grid.x < 0
+            self.grid.q[:, :] = rho_r, S_r, E_r
+            self.grid.q[left, :] = rho_l, S_l, E_l
         elif type == "advection":
             x = self.grid.x
             rho_0 = 1e-3
@@ -147,9 +202,9 @@ class WENOSimulation(object):
             S = rho * v
             e = p / rho / (self.eos_gamma - 1)
             E = rho * (e + v**2 / 2)
-            self.grid.q[0, :] = rho[:]
-            self.grid.q[1, :] = S[:]
-            self.grid.q[2, :] = E[:]
+            self.grid.q[:, 0] = rho[:]
+            self.grid.q[:, 1] = S[:]
+            self.grid.q[:, 2] = E[:]
         elif type == "double rarefaction":
             rho_l = 1
             rho_r = 1
@@ -163,39 +218,45 @@ class WENOSimulation(object):
             e_r = p_r / rho_r / (self.eos_gamma - 1)
             E_l = rho_l * (e_l + v_l**2 / 2)
             E_r = rho_r * (e_r + v_r**2 / 2)
-            self.grid.q[0] = numpy.where(self.grid.x < 0,
-                                         rho_l * numpy.ones_like(self.grid.x),
-                                         rho_r * numpy.ones_like(self.grid.x))
-            self.grid.q[1] = numpy.where(self.grid.x < 0,
-                                         S_l * numpy.ones_like(self.grid.x),
-                                         S_r * numpy.ones_like(self.grid.x))
-            self.grid.q[2] = numpy.where(self.grid.x < 0,
-                                         E_l * numpy.ones_like(self.grid.x),
-                                         E_r * numpy.ones_like(self.grid.x))
+            left = self.grid.x < 0
+            self.grid.q[:, :] = rho_r, S_r, E_r
+            self.grid.q[left, :] = rho_l, S_l, E_l
 
 
     def max_lambda(self):
-        rho = self.grid.q[0]
-        v = self.grid.q[1] / rho
-        p = (self.eos_gamma - 1) * (self.grid.q[2, :] - rho * v**2 / 2)
+        rho = self.grid.q[:, 0]
+        v = self.grid.q[:, 1] / rho
+        p = (self.eos_gamma - 1) * (self.grid.q[:, 2] - rho * v**2 / 2)
         cs = numpy.sqrt(self.eos_gamma * p / rho)
         return max(numpy.abs(v) + cs)
 
 
     def timestep(self):
-        return self.C * self.grid.dx / self.max_lambda()
+        # the wavespeed is kept for the Lax-Friedrichs flux splitting
+        # in the RK substeps of this step
+        self._max_lambda = self.max_lambda()
+        return self.C * self.grid.dx / self._max_lambda
 
 
     def euler_flux(self, q):
-        flux = numpy.zeros_like(q)
-        rho = q[0, :]
-        S = q[1, :]
-        E = q[2, :]
+        """
+        Return the Euler flux of q.  For a state shaped like the grid
+        this is written into a buffer that is reused on the next call.
+        """
+        if q.shape == self._flux.shape:
+            flux = self._flux
+        else:
+            flux = numpy.empty_like(q)
+        rho = q[:, 0]
+        S = q[:, 1]
+        E = q[:, 2]
         v = S / rho
-        p = (self.eos_gamma - 1) * (E - rho * v**2 / 2)
-        flux[0, :] = S
-        flux[1, :] = S * v + p
-        flux[2, :] = (E + p) * v
+        p = (self.eos_gamma - 1) * (E - S * v / 2)
+        flux[:, 0] = S
+        numpy.multiply(S, v, out=flux[:, 1])
+        flux[:, 1] += p
+        numpy.add(E, p, out=flux[:, 2])
+        flux[:, 2] *= v
         return flux
 
 
@@ -204,17 +265,24 @@ class WENOSimulation(object):
         g = self.grid
         g.fill_BCs()
         f = self.euler_flux(g.q)
-        alpha = self.max_lambda()
+        alpha = self._max_lambda
         fp = (f + alpha * g.q) / 2
         fm = (f - alpha * g.q) / 2
-        fpr = g.scratch_array()
-        fml = g.scratch_array()
-        flux = g.scratch_array()
-        fpr[:, 1:] = weno(self.weno_order, fp[:, :-1])
-        fml[:, -1::-1] = weno(self.weno_order, fm[:, -1::-1])
-        flux[:, 1:-1] = fpr[:, 1:-1] + fml[:, 1:-1]
-        rhs = g.scratch_array()
-        rhs[:, 1:-1] = 1/g.dx * (flux[:, 1:-1] - flux[:, 2:])
+        # these are fully overwritten, apart from the end points that
+        # we zero explicitly (fpr[0] and flux[0] are never read)
+        fpr = numpy.empty_like(g.q)
+        fml = numpy.empty_like(g.q)
+        flux = numpy.empty_like(g.q)
+        fpr[1:, :] = weno(self.weno_order, fp[:-1, :])
+        numpy.copyto(self._rev_in, fm[::-1, :])
+        weno(self.weno_order, self._rev_in, self._rev_out)
+        fml[::-1, :] = self._rev_out
+        flux[1:-1, :] = fpr[1:-1, :] + fml[1:-1, :]
+        flux[-1, :] = 0.0
+        rhs = numpy.empty_like(g.q)
+        rhs[1:-1, :] = 1/g.dx * (flux[1:-1, :] - flux[2:, :])
+        rhs[0, :] = 0.0
+        rhs[-1, :] = 0.0
         return rhs
 
     
@@ -263,7 +331,7 @@ class WENOSimulation(object):
         g.fill_BCs()
         f = self.euler_flux(g.q)
         w_o = self.weno_order
-        alpha = self.max_lambda()
+        alpha = self._max_lambda
         fp = (f + alpha * g.q) / 2
         fm = (f - alpha * g.q) / 2
         char_fm = g.scratch_array()
@@ -272,18 +340,18 @@ class WENOSimulation(object):
         fml = g.scratch_array()
         flux = g.scratch_array()
         for i in range(g.ilo, g.ihi+2):
-            boundary_state = (g.q[:, i-1] + g.q[:, i]) / 2
+            boundary_state = (g.q[i-1, :] + g.q[i, :]) / 2
             revecs, levecs = self.evecs(boundary_state)
             for j in range(i-w_o-1, i+w_o+2):
-                char_fm[:, j] = numpy.dot(fm[:, j], levecs)
-                char_fp[:, j] = numpy.dot(fp[:, j], levecs)
-            fpr[:, i-w_o:i+w_o+2] = weno(self.weno_order,
-                                           char_fp[:, i-w_o-1:i+w_o+1])
-            fml[:, i+w_o+1:i-w_o-1:-1] = weno(self.weno_order,
-                                               char_fm[:, i+w_o+1:i-w_o-1:-1])
-            flux[:, i] = numpy.dot(revecs, fpr[:, i] + fml[:, i])
+                char_fm[j, :] = numpy.dot(fm[j, :], levecs)
+                char_fp[j, :] = numpy.dot(fp[j, :], levecs)
+            fpr[i-w_o:i+w_o+2, :] = weno(self.weno_order,
+                                           char_fp[i-w_o-1:i+w_o+1, :])
+            fml[i+w_o+1:i-w_o-1:-1, :] = weno(self.weno_order,
+                                               char_fm[i+w_o+1:i-w_o-1:-1, :])
+            flux[i, :] = numpy.dot(revecs, fpr[i, :] + fml[i, :])
         rhs = g.scratch_array()
-        rhs[:, 1:-1] = 1/g.dx * (flux[:, 1:-1] - flux[:, 2:])
+        rhs[1:-1, :] = 1/g.dx * (flux[1:-1, :] - flux[2:, :])
         return rhs
 
 
@@ -321,13 +389,31 @@ class WENOSimulation(object):
 #            g.q = q_start + (k1 + 2 * (k2 + k3) + k4) / 6
 
             # RK3: this is SSP
-            # Store the data at the start of the step
-            q_start = g.q.copy()
-            q1 = q_start + dt * stepper()
-            g.q[:, :] = q1[:, :]
-            q2 = (3 * q_start + q1 + dt * stepper()) / 4
-            g.q[:, :] = q2[:, :]
-            g.q = (q_start + 2 * q2 + 2 * dt * stepper()) / 3
+            # Store the data at the start of the step.  Each stage is
+            # built in place in g.q to avoid temporaries
+            q_start = self._q_start
+            numpy.copyto(q_start, g.q)
+
+            # q1 = q_start + dt L(q_start)
+            rhs = stepper()
+            rhs *= dt
+            g.q += rhs
+
+            # q2 = (3 q_start + q1 + dt L(q1)) / 4
+            rhs = stepper()
+            rhs *= dt
+            g.q += rhs
+            numpy.multiply(q_start, 3, out=self._acc)
+            g.q += self._acc
+            g.q *= 0.25
+
+            # q = (q_start + 2 q2 + 2 dt L(q2)) / 3
+            rhs = stepper()
+            rhs *= 2 * dt
+            g.q *= 2
+            g.q += rhs
+            g.q += q_start
+            g.q /= 3
 
             self.t += dt
 #            print("t=", self.t)
@@ -372,10 +458,10 @@ if __name__ == "__main__":
             s.evolve(tmax, reconstruction=recon)
             g = s.grid
             x = g.x + 0.5
-            rho = g.q[0, :]
-            v = g.q[1, :] / g.q[0, :]
-            e = (g.q[2, :] - rho * v**2 / 2) / rho
-            p = (s.eos_gamma - 1) * (g.q[2, :] - rho * v**2 / 2)
+            rho = g.q[:, 0]
+            v = g.q[:, 1] / g.q[:, 0]
+            e = (g.q[:, 2] - rho * v**2 / 2) / rho
+            p = (s.eos_gamma - 1) * (g.q[:, 2] - rho * v**2 / 2)
             axes[0, i].plot(x[g.ilo:g.ihi+1], rho[g.ilo:g.ihi+1], 'bo')
             axes[0, i].plot(x_e, rho_e, 'k--')
             axes[1, i].plot(x[g.ilo:g.ihi+1], v[g.ilo:g.ihi+1], 'bo')
@@ -432,10 +518,10 @@ if __name__ == "__main__":
 #        s.evolve(tmax, reconstruction='characteristic')
         g = s.grid
         x = g.x + 0.5
-        rho = g.q[0, :]
-        v = g.q[1, :] / g.q[0, :]
-        e = (g.q[2, :] - rho * v**2 / 2) / rho
-        p = (s.eos_gamma - 1) * (g.q[2, :] - rho * v**2 / 2)
+        rho = g.q[:, 0]
+        v = g.q[:, 1] / g.q[:, 0]
+        e = (g.q[:, 2] - rho * v**2 / 2) / rho
+        p = (s.eos_gamma - 1) * (g.q[:, 2] - rho * v**2 / 2)
         fig, axes = pyplot.subplots(4, 1, sharex=True, figsize=(6,10))
         axes[0].plot(x[g.ilo:g.ihi+1], rho[g.ilo:g.ihi+1], 'bo')
         axes[0].plot(x_e, rho_e, 'k--')
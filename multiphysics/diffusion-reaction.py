@@ -12,7 +12,7 @@ from __future__ import print_function
 
 import numpy as np
 from scipy import linalg
-from scipy.integrate import ode
+from numba import njit, prange
 import sys
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -24,31 +24,54 @@ mpl.rcParams['font.size'] = 12
 mpl.rcParams['legend.fontsize'] = 'large'
 mpl.rcParams['figure.titlesize'] = 'medium'
 
+@njit(cache=True)
 def frhs(t, phi, tau):
     """ reaction ODE righthand side """
     return 0.25*phi*(1.0 - phi)/tau
 
-def jac(t, phi):
-    return None
-
-def react(gr, phi, tau, dt):
-    """ react phi through timestep dt """
+@njit(cache=True, fastmath=True, parallel=True)
+def react_kernel(phi_in, phi_out, tau, dt, nsteps):
+    """ integrate the reactions in each zone with nsteps of RK4 """
+
+    h = dt/nsteps
+
+    for i in prange(phi_in.shape[0]):
+        y = phi_in[i]
+        t = 0.0
+        for n in range(nsteps):
+            k1 = frhs(t, y, tau)
+            k2 = frhs(t + 0.5*h, y + 0.5*h*k1, tau)
+            k3 = frhs(t + 0.5*h, y + 0.5*h*k2, tau)
+            k4 = frhs(t + h, y + h*k3, tau)
+            y += h*(k1 + 2.0*k2 + 2.0*k3 + k4)/6.0
+            t += h
+        phi_out[i] = y
+
+def react(gr, phi, tau, dt, phinew=None):
+    """
+    react phi through timestep dt.  The result is stored in the valid
+    zones of phinew if given -- its ghost cells are left untouched.
+    phinew may be phi itself
+    """
 
-    phinew = gr.scratch_array()
+    if phinew is None:
+        phinew = gr.scratch_array()
 
-    for i in range(gr.ilo, gr.ihi+1):
-        r = ode(frhs,jac).set_integrator("vode", method="adams",
-                                         with_jacobian=False)
-        r.set_initial_value(phi[i], 0.0).set_f_params(tau)
-        r.integrate(r.t+dt)
-        phinew[i] = r.y[0]
+    # there is no spatial coupling in the reactions, so each zone is
+    # integrated independently
+    react_kernel(phi[gr.ilo:gr.ihi+1], phinew[gr.ilo:gr.ihi+1], tau, dt, 4)
 
     return phinew
 
-def diffuse(gr, phi, kappa, dt):
-    """ diffuse phi implicitly (C-N) through timestep dt """
+def diffuse(gr, phi, kappa, dt, phinew=None):
+    """
+    diffuse phi implicitly (C-N) through timestep dt.  The result is
+    stored in the valid zones of phinew if given -- its ghost cells are
+    left untouched
+    """
 
-    phinew = gr.scratch_array()
+    if phinew is None:
+        phinew = gr.scratch_array()
 
     alpha = kappa*dt/gr.dx**2
 
@@ -59,30 +82,33 @@ def diffuse(gr, phi, kappa, dt):
                        phi[gr.ilo+1:gr.ihi+2])
 
 
-    # create the diagonal, d+1 and d-1 parts of the matrix
-    d = (1.0 + alpha)*np.ones(gr.nx)
-    u = -0.5*alpha*np.ones(gr.nx)
-    u[0] = 0.0
+    # the C-N matrix is symmetric positive definite, so we only store
+    # the diagonal and superdiagonal, in the upper form expected by
+    # solveh_banded.  This is overwritten by the solve, so we refill it
+    # each call
+    ab = gr.ab
 
-    l = -0.5*alpha*np.ones(gr.nx)
-    l[gr.nx-1] = 0.0
+    ab[0, 0] = 0.0
+    ab[0, 1:] = -0.5*alpha
+    ab[1, :] = 1.0 + alpha
 
     # set the boundary conditions by changing the matrix elements
 
     # homogeneous neumann
-    d[0] = 1.0 + 0.5*alpha
-    d[gr.nx-1] = 1.0 + 0.5*alpha
+    ab[1, 0] = 1.0 + 0.5*alpha
+    ab[1, gr.nx-1] = 1.0 + 0.5*alpha
 
     # dirichlet
-    #d[0] = 1.0 + 1.5*alpha
+    #ab[1, 0] = 1.0 + 1.5*alpha
     #R[0] += alpha*0.0
 
-    #d[gr.nx-1] = 1.0 + 1.5*alpha
+    #ab[1, gr.nx-1] = 1.0 + 1.5*alpha
     #R[gr.nx-1] += alpha*0.0
 
     # solve
-    A = np.matrix([u,d,l])
-    phinew[gr.ilo:gr.ihi+1] = linalg.solve_banded((1,1), A, R)
+    phinew[gr.ilo:gr.ihi+1] = linalg.solveh_banded(ab, R, overwrite_ab=True,
+                                                   overwrite_b=True,
+                                                   check_finite=False)
 
     return phinew
 
@@ -114,6 +140,9 @@ class Grid(object):
 
         self.data = {}
 
+        # storage for the banded implicit diffusion matrix
+        self.ab = np.zeros((2, nx), dtype=np.float64)
+
         for v in vars:
             self.data[v] = np.zeros((2*ng+nx), dtype=np.float64)
 
@@ -136,7 +165,11 @@ class Grid(object):
 
         phi = self.data["phi"]
         phi[:] = 0.0
-        phi[self.nx//2-int(0.15*self.nx):self.nx//2+int(0.15*self.nx)+1] = 1.0
+
+        # a burned region of half-width 15% of the domain in the center
+        c = self.nx//2
+        w = int(0.15*self.nx)
+        phi[c-w:c+w+1] = 1.0
 
 
 def interpolate(x, phi, phipt):
@@ -165,33 +198,40 @@ def interpolate(x, phi, phipt):
 
     return xpos
 
-def evolve(nx, kappa, tau, tmax, dovis=0, return_initial=0):
+def evolve(nx, kappa, tau, tmax, dovis=0, return_initial=0, plot_every=50):
     """
     the main evolution loop.  Evolve
 
      phi_t = kappa phi_{xx} + (1/tau) R(phi)
 
-    from t = 0 to tmax
+    from t = 0 to tmax.  With dovis = 1 the plot is updated every
+    plot_every steps and at the end
     """
 
     # create the grid
     gr = Grid(nx, ng=1, xmin = 0.0, xmax=100.0,
-              vars=["phi", "phi1", "phi2"])
+              vars=["phi", "phi_tmp"])
 
-    # pointers to the data at various stages
-    phi  = gr.data["phi"]
-    phi1 = gr.data["phi1"]
-    phi2 = gr.data["phi2"]
+    # pointers to the solution and the intermediate diffusion result
+    phi = gr.data["phi"]
+    phi_tmp = gr.data["phi_tmp"]
 
     # initialize
     gr.initialize()
 
     phi_init = phi.copy()
 
-    # runtime plotting
-    if dovis == 1: plt.ion()
+    # runtime plotting -- we create the line once and just update its
+    # data as we evolve
+    if dovis == 1:
+        plt.ion()
+        plt.clf()
+        line, = plt.plot(gr.x, phi)
+        plt.xlim(gr.xmin,gr.xmax)
+        plt.ylim(0.0,1.0)
 
     t = 0.0
+    n = 0
     while t < tmax:
 
         dt = est_dt(gr, kappa, tau)
@@ -199,26 +239,26 @@ def evolve(nx, kappa, tau, tmax, dovis=0, return_initial=0):
         if t + dt > tmax:
             dt = tmax - t
 
-        # react for dt/2
-        phi1[:] = react(gr, phi, tau, dt/2)
-        gr.fillBC("phi1")
+        # react for dt/2 -- the reactions are local to each zone, so
+        # this can be done in place
+        react(gr, phi, tau, dt/2, phinew=phi)
+        gr.fillBC("phi")
 
         # diffuse for dt
-        phi2[:] = diffuse(gr, phi1, kappa, dt)
-        gr.fillBC("phi2")
+        diffuse(gr, phi, kappa, dt, phinew=phi_tmp)
+        gr.fillBC("phi_tmp")
 
         # react for dt/2 -- this is the updated solution
-        phi[:] = react(gr, phi2, tau, dt/2)
+        react(gr, phi_tmp, tau, dt/2, phinew=phi)
         gr.fillBC("phi")
 
         t += dt
+        n += 1
 
-        if dovis == 1:
-            plt.clf()
-            plt.plot(gr.x, phi)
-            plt.xlim(gr.xmin,gr.xmax)
-            plt.ylim(0.0,1.0)
-            plt.draw()
+        if dovis == 1 and (n % plot_every == 0 or t >= tmax):
+            line.set_ydata(phi)
+            line.figure.canvas.draw_idle()
+            plt.pause(0.001)
 
     if return_initial == 1:
         return phi, gr.x, phi_init